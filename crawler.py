@@ -2,22 +2,48 @@ import argparse
 import multiprocessing
 import json
 import asyncio
-import aiohttp
+import httpx
 import logging
 import traceback
 import time
-from os import path, getenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from urllib.parse import urlparse, urljoin
-from urllib.robotparser import RobotFileParser
-from bs4 import BeautifulSoup
+import re
+import sys
+from collections import defaultdict
+from os import getenv
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from urllib.parse import urlparse, urlsplit, urljoin
+from lxml import etree
+from pybloom_live import ScalableBloomFilter
+import pygtrie
 from dotenv import load_dotenv
 
+# uvloop is not available on Windows, fall back to the default asyncio loop there
+try:
+  import uvloop
+except ImportError:
+  uvloop = None
+
 MAX_WORKERS = multiprocessing.cpu_count()
 MAX_URL_SIZE = 10000
+NUM_CRAWLERS = 500
+MAX_CONNECTIONS_PER_HOST = 4
+REQUEST_TIMEOUT = 10
+MAX_NOVELTY = sys.maxsize
 GOOGLE_SEARCH_API_BASE = "https://www.googleapis.com/customsearch/v1"
 
-IGNORE_TYPE = {".img", ".jpg", ".png", ".jpeg", ".gif", ".mp3", ".mp4", ".cgi", ".wav", ".avi", "wmv", "flv"}
+IGNORE_TYPE = {".img", ".jpg", ".png", ".jpeg", ".gif", ".mp3", ".mp4", ".cgi", ".wav", ".avi", ".wmv", ".flv",
+               ".pdf", ".zip", ".tar", ".gz", ".svg", ".ico", ".css", ".js", ".woff", ".woff2"}
+# matches an ignored extension at the end of a path, so hrefs can be rejected before being parsed
+SKIP_RE = re.compile(r"\.(?:%s)$" % "|".join(re.escape(ext[1:]) for ext in IGNORE_TYPE), re.I)
+# compiled once, evaluated in C on every page; plain strings so the results don't keep the tree alive
+HREF_XPATH = etree.XPath("//a/@href", smart_strings=False)
+
+# robots.txt rules per netloc, as a trie of path prefixes mapped to whether they may be crawled
+# the lock makes sure each host's robots.txt is only downloaded once
+HOST_TRIES = {}
+ROBOTS_LOCKS = defaultdict(asyncio.Lock)
+# caps the requests in flight to one netloc, httpx only limits the pool as a whole
+HOST_SEMAPHORES = defaultdict(lambda: asyncio.Semaphore(MAX_CONNECTIONS_PER_HOST))
 
 # 1. start from a set of seed pages obtained from a major search engine
 # given a query (a set of keywords) provided by auser, your crawler should contact a major search engine 
@@ -45,79 +71,238 @@ IGNORE_TYPE = {".img", ".jpg", ".png", ".jpeg", ".gif", ".mp3", ".mp4", ".cgi",
 
 def parse_args():
   parser = argparse.ArgumentParser(description='Web crawler')
-  parser.add_argument("-d", "--depth", help="Maximum crawling depth", default=3)
-  parser.add_argument("-k", "--keyword", help="Search keyword", default="python")
-  parser.add_argument("-s", "--size", help="Max Page Crawled", default=100)
+  parser.add_argument("-d", "--depth", help="Maximum crawling depth", type=int, default=3)
+  parser.add_argument("-k", "--keyword", help="Search keyword", type=str, default="python")
+  parser.add_argument("-s", "--size", help="Max Page Crawled", type=int, default=100)
   return parser.parse_args()
 
 
-async def get_req(url, timeout=5):
-  try:
-    resp = await session.get(url, timeout=timeout)
+# returns the raw body in bytes and the charset of the Content-Type header, if any, decoding is left to
+# the consumer (lxml and json both accept bytes)
+# if content_type is given, responses of any other MIME type are released without downloading the body
+async def read_body(session, url, content_type):
+  async with session.stream("GET", url) as resp:
     resp.raise_for_status()
-    return await resp.text(), True
-  except:
+    if content_type and resp.headers.get("Content-Type", "").partition(";")[0].strip().lower() != content_type:
+      return None, None, False
+    return await resp.aread(), resp.charset_encoding, True
+
+
+# httpx timeouts only apply per operation, so the whole request is bounded here
+async def get_req(session, url, content_type=None):
+  try:
+    async with HOST_SEMAPHORES[urlparse(url).netloc]:
+      return await asyncio.wait_for(read_body(session, url, content_type), REQUEST_TIMEOUT)
+  except Exception:
     logging.error(traceback.format_exc())
-    return None, False
+    return None, None, False
 
 
 # given an initial search query and return an array of seed urls
-async def get_seed_urls(init_url):
-  results, ok = await get_req(init_url)
+async def get_seed_urls(session, init_url):
+  results, _, ok = await get_req(session, init_url)
   if not ok:
     raise Exception("Failed to get results from root server")
   return [item['formattedUrl'] for item in json.loads(results)['items']]
 
 
-# A JOB as a thread pool task, which takes an url and return the sub-urls from given HTML docs
-async def url_job(url):
-  parsed_url = urlparse(url)
-  self_req_scheme, self_netloc = parsed_url.scheme, parsed_url.netloc
-  html_doc, ok = await get_req(url)
-  if not ok:
+# build the rules trie from the Allow/Disallow lines of the "User-agent: *" groups of a robots.txt
+def parse_robots(lines):
+  trie = pygtrie.CharTrie()
+  in_agents, applies = False, False
+  for line in lines:
+    field, _, value = line.split("#", 1)[0].partition(":")
+    field, value = field.strip().lower(), value.strip()
+    if field == "user-agent":
+      # consecutive User-agent lines share the rules that follow them
+      applies = (applies and in_agents) or value == "*"
+      in_agents = True
+    elif field in ("allow", "disallow"):
+      in_agents = False
+      # an empty Disallow allows everything; when both rules name the same path, Allow wins
+      if applies and value and (field == "allow" or value not in trie):
+        trie[value] = field == "allow"
+  return trie
+
+
+# return the cached robots.txt rules of a host, fetching them on first use
+async def get_robots(session, scheme, netloc):
+  trie = HOST_TRIES.get(netloc)
+  if trie is not None:
+    return trie
+  async with ROBOTS_LOCKS[netloc]:
+    if netloc not in HOST_TRIES:
+      # same status handling as RobotFileParser.read(): 401/403 or no answer refuse the whole host,
+      # any other 4xx means there are no rules
+      trie = pygtrie.CharTrie({"/": False})
+      try:
+        async with HOST_SEMAPHORES[netloc]:
+          resp = await asyncio.wait_for(session.get(f"{scheme}://{netloc}/robots.txt"), REQUEST_TIMEOUT)
+        if 400 <= resp.status_code < 500 and resp.status_code not in (401, 403):
+          trie = pygtrie.CharTrie()
+        elif resp.status_code not in (401, 403):
+          resp.raise_for_status()
+          trie = parse_robots(resp.content.decode("utf-8", errors="ignore").splitlines())
+      except Exception:
+        logging.error(traceback.format_exc())
+      HOST_TRIES[netloc] = trie
+  return HOST_TRIES[netloc]
+
+
+# runs in the process pool, takes a HTML doc and the "scheme://netloc" of its page and returns the sub-urls
+# without a header charset lxml falls back on the BOM or <meta charset>, then on Latin-1
+def extract_links(html_doc, base_url, encoding=None):
+  root = etree.HTML(html_doc, etree.HTMLParser(encoding=encoding))
+  if root is None:
     return set()
-  soup = BeautifulSoup(html_doc, "html.parser")
+  hrefs = HREF_XPATH(root)
+  self_req_scheme = base_url[:base_url.index(":")]
   url_set = set()
-  rp = RobotFileParser(urljoin(f"{self_req_scheme}://{self_netloc}", "robots.txt"))
-  rp.read()
-  for link in soup.find_all("a"):
-    result = urlparse(link.get("href"))
-    url = urljoin(f"{self_req_scheme}://{result.netloc if result.netloc else self_netloc}", result.path)
-    if not url:
+  for href in hrefs:
+    # only the path is kept, same as before, but without building a ParseResult per anchor
+    href = href.split("#", 1)[0].split("?", 1)[0]
+    if SKIP_RE.search(href):
       continue
-    file_name, file_extension = path.splitext(url)
-    if file_extension in IGNORE_TYPE or rp.can_fetch("*", url):
+    try:
+      if href.startswith(("http://", "https://")):
+        url = href
+      elif href.startswith("//"):
+        url = f"{self_req_scheme}:{href}"
+      elif href.startswith("/"):
+        url = base_url + href
+      else:
+        url = urljoin(base_url, href)
+        # mailto:, javascript: and the like
+        if not url.startswith(("http://", "https://")):
+          continue
+      # malformed hrefs such as "http://[bad/x" would otherwise only fail once popped from the frontier
+      urlsplit(url)
+    except ValueError:
       continue
     url_set.add(url)
   return url_set
 
 
+# A JOB as a coroutine, which takes an url, downloads it with the given session and return the sub-urls
+# found by extract_links in the given executor, along with whether the page was actually downloaded
+async def url_job(session, executor, url):
+  try:
+    parsed_url = urlparse(url)
+    self_req_scheme, self_netloc = parsed_url.scheme, parsed_url.netloc
+    # the longest matching prefix is the most specific rule, O(len(path)) whatever the number of rules
+    rule = (await get_robots(session, self_req_scheme, self_netloc)).longest_prefix(parsed_url.path or "/")
+  except Exception:
+    logging.error(traceback.format_exc())
+    return set(), False
+  if rule and not rule.value:
+    return set(), False
+  html_doc, charset, ok = await get_req(session, url, content_type="text/html")
+  if not ok:
+    return set(), False
+  try:
+    # parsing holds the GIL, so it runs in the process pool and the event loop only does I/O
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, extract_links, html_doc, f"{self_req_scheme}://{self_netloc}", charset), True
+  except Exception:
+    logging.error(traceback.format_exc())
+    return set(), True
+
+
 async def main():
-  global session
-  async with aiohttp.ClientSession() as session:
-    start = time.perf_counter()
-    load_dotenv()
-    args = parse_args()
-    MAX_URL_SIZE = int(args.size)
-    queue = await get_seed_urls(f"{GOOGLE_SEARCH_API_BASE}?key={getenv('GOOGLE_SEARCH_API_KEY')}&cx={getenv('GOOGLE_SEARCH_ENGINE_ID')}&q={args.keyword}")
-    url_set = set(queue)
-    batch_size = 100
-    count = 0
-    while count < MAX_URL_SIZE:
-      curr = queue[:batch_size]
-      queue = queue[batch_size:]
-      count += len(curr)
-      print(f"{count} urls crawled")
-      for result in await asyncio.gather(*[url_job(url) for url in curr]):
-        for url in result:
-          if url not in url_set:
-            url_set.add(url)
-            queue.append(url)
-    
-    print(url_set)
-    print(f"Time elapsed: {time.perf_counter() - start:.3f}s, {len(url_set)} of URL found")
+  # HTTP/2 multiplexes the requests to one origin over a single keep-alive connection
+  limits = httpx.Limits(max_connections=1000, max_keepalive_connections=200)
+  timeout = httpx.Timeout(REQUEST_TIMEOUT, connect=5, read=5)
+  with ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    async with httpx.AsyncClient(http2=True, limits=limits, timeout=timeout, verify=False, follow_redirects=True) as session:
+      start = time.perf_counter()
+      load_dotenv()
+      args = parse_args()
+      MAX_URL_SIZE, MAX_DEPTH = args.size, args.depth
+      # nothing to crawl, and a zero-permit budget would block every crawler forever
+      if MAX_URL_SIZE <= 0:
+        return
+      seeds = await get_seed_urls(session, f"{GOOGLE_SEARCH_API_BASE}?key={getenv('GOOGLE_SEARCH_API_KEY')}&cx={getenv('GOOGLE_SEARCH_ENGINE_ID')}&q={args.keyword}")
+      # every URL already crawled, a false positive only costs skipping an unseen page
+      seen = ScalableBloomFilter(initial_capacity=1_000_000, error_rate=1e-4)
+      visited = []
+      # scores and shallowest depth of the URLs waiting in the frontier, entries are dropped once the URL is crawled
+      importance, novelty, depth = {}, {}, {}
+      # best-first frontier, a URL is pushed again whenever its score changes and stale entries are skipped
+      frontier = asyncio.PriorityQueue()
+      found = 0
+
+      # takes the set of links found at the given depth, new URLs are initialised with bulk set/dict operations
+      def discover(urls, level, weight=1):
+        nonlocal found
+        urls = {url for url in urls if url not in seen}
+        new = urls.difference(importance)
+        found += len(new)
+        importance.update(dict.fromkeys(new, 0))
+        novelty.update(dict.fromkeys(new, MAX_NOVELTY))
+        depth.update(dict.fromkeys(new, level))
+        for url in urls:
+          importance[url] += weight
+          novelty[url] -= weight
+          depth[url] = min(depth[url], level)
+          # among equally scored URLs the shallower one goes first
+          frontier.put_nowait((-importance[url], novelty[url], depth[url], url))
+
+      discover(set(seeds), 0, weight=0)
+      count = 0
+      # one permit per page of the --size budget, taken before popping a URL so every page started gets finished
+      budget = asyncio.Semaphore(MAX_URL_SIZE)
+      done = asyncio.Event()
+
+      # each crawler keeps pulling from the frontier, so a slow page only holds up its own crawler
+      async def crawler():
+        nonlocal count
+        while True:
+          await budget.acquire()
+          _, _, _, curr = await frontier.get()
+          counted = False
+          try:
+            # add() reports whether the url was already in the filter
+            if seen.add(curr):
+              continue
+            del importance[curr], novelty[curr]
+            level = depth.pop(curr)
+            links, ok = await url_job(session, executor, curr)
+            # refused by robots.txt, not HTML or failed: not crawled
+            if not ok:
+              continue
+            count += 1
+            counted = True
+            visited.append(curr)
+            # the budget is used up, the other crawlers are all idle waiting for a permit or a URL
+            if count >= MAX_URL_SIZE:
+              done.set()
+            if count % 100 == 0:
+              print(f"{count} urls crawled")
+            # pages at the maximum depth are crawled, but their links are not followed
+            if level < MAX_DEPTH:
+              discover(links, level + 1)
+          except Exception:
+            logging.error(traceback.format_exc())
+          finally:
+            # any page that was not counted, whatever the reason, gives its permit back
+            if not counted:
+              budget.release()
+            frontier.task_done()
+
+      crawlers = [asyncio.create_task(crawler()) for _ in range(NUM_CRAWLERS)]
+      # stop once enough pages are crawled, or when the frontier runs dry; no page is in flight by then
+      waiters = [asyncio.create_task(done.wait()), asyncio.create_task(frontier.join())]
+      await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+      for task in crawlers + waiters:
+        task.cancel()
+      await asyncio.gather(*crawlers, *waiters, return_exceptions=True)
+
+      print(visited)
+      print(f"Time elapsed: {time.perf_counter() - start:.3f}s, {found} of URL found")
 
 if __name__ == "__main__":
+  if uvloop:
+    uvloop.install()
   routine = main()
   try:
     asyncio.run(routine)